@@ -8,6 +8,9 @@ __version__ = version(__package__)
 HOME_DIR = (Path(__file__).parent / "..").resolve()
 DATA_DIR = HOME_DIR / "data"
 
+# Local cache directory (kept outside of DATA_DIR so it never gets synced)
+CACHE_DIR = HOME_DIR / ".cache"
+
 # Scraping sources
 SOURCES = ["court_summary", "portal", "bail"]
 
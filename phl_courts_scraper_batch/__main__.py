@@ -1,8 +1,6 @@
 import click
 
 from . import APP_NAME, DATA_DIR, SOURCES
-from .aws import AWS
-from .scrape import scrape as _scrape
 
 
 @click.group()
@@ -84,6 +82,16 @@ def cli():
     "--ntasks", default=20, type=int, help="The number of tasks to use on AWS."
 )
 @click.option("--no-wait", is_flag=True, help="Whether to wait for AWS jobs to finish")
+@click.option(
+    "--fail-fast",
+    is_flag=True,
+    help="Stop all AWS tasks as soon as one of them fails",
+)
+@click.option(
+    "--refresh-cluster",
+    is_flag=True,
+    help="Re-fetch the cached ECS cluster metadata (e.g., after a new task definition)",
+)
 @click.option("--debug", is_flag=True)
 def scrape(
     flavor,
@@ -104,9 +112,14 @@ def scrape(
     aws=False,
     ntasks=20,
     no_wait=False,
+    fail_fast=False,
+    refresh_cluster=False,
     debug=False,
 ):
     """Scrape court-related data from the specified source."""
+    # NOTE: imported here so that the CLI itself starts up quickly
+    from .aws import AWS
+    from .scrape import scrape as _scrape
 
     # Get the arguments
     kwargs = {
@@ -134,6 +147,8 @@ def scrape(
             **kwargs,
             ntasks=ntasks,
             wait=(not no_wait),
+            fail_fast=fail_fast,
+            refresh_cluster=refresh_cluster,
         )
     # Run locally
     else:
@@ -144,6 +159,8 @@ def scrape(
 @click.option("--dry-run", is_flag=True, help="Do not save the results; dry run only.")
 def sync_from_aws(from_aws=True, dry_run=False):
     """Sync scraping results from AWS."""
+    from .aws import AWS
+
     aws = AWS()
     source = f"s3://{APP_NAME}"
     dest = DATA_DIR
@@ -154,6 +171,8 @@ def sync_from_aws(from_aws=True, dry_run=False):
 @click.option("--dry-run", is_flag=True, help="Do not save the results; dry run only.")
 def sync_to_aws(dry_run=False):
     """Sync scraping results to/from AWS."""
+    from .aws import AWS
+
     aws = AWS()
     dest = f"s3://{APP_NAME}"
     source = str(DATA_DIR)
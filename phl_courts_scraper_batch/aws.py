@@ -1,26 +1,109 @@
 import os
-from pathlib import Path
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from io import BytesIO
+from itertools import chain
 
-import boto3
-import pandas as pd
-import simplejson as json
+import orjson
 from dotenv import find_dotenv, load_dotenv
-from fsspec.implementations.local import LocalFileSystem
 from loguru import logger
-from s3fs import S3FileSystem
 
-from . import APP_NAME, DATA_DIR, HOME_DIR, io
+from . import APP_NAME, CACHE_DIR, DATA_DIR, HOME_DIR, io
+
+# The home directory, as a string for fast path manipulation
+HOME_STR = str(HOME_DIR)
+
+# Max number of concurrent connections to AWS
+MAX_POOL_CONNECTIONS = 32
+
+# Max number of concurrent task submissions to ECS
+MAX_SUBMIT_WORKERS = 20
+
+# Max number of concurrent transfers when syncing
+SYNC_BATCH_SIZE = 20
+
+# Polling schedule when waiting for ECS tasks (in seconds)
+POLL_INITIAL_DELAY = 2
+POLL_BACKOFF = 1.5
+POLL_MAX_DELAY = 60
+POLL_TIMEOUT = 500 * 60
+
+# Max number of tasks per describe_tasks call (ECS API limit)
+DESCRIBE_TASKS_BATCH_SIZE = 100
+
+# Local cache of the ECS cluster metadata
+CLUSTER_CACHE_FILE = CACHE_DIR / "aws_cluster.json"
+CLUSTER_CACHE_TTL = 60 * 60  # in seconds
+
+# How long a local marker that the output bucket has been verified is valid
+BUCKET_MARKER_TTL = 7 * 24 * 60 * 60  # in seconds
 
 
 def parse_aws_path(path):
     """Split a path on AWS into bucket and key."""
 
     path = str(path)
-    bucket = path.split("/")[2]
-    key = "/".join(path.split("/")[3:])
+    if path.startswith("s3://"):
+        path = path[5:]
+    bucket, _, key = path.partition("/")
     return bucket, key
 
 
+def _relative_to_home(path):
+    """Get a path relative to HOME_DIR, using string operations only."""
+    return os.path.relpath(os.path.abspath(path), HOME_STR)
+
+
+def _list_files(fs, path, local=False, relative=False):
+    """
+    List all files below a path with a single call.
+
+    Returns a dict mapping each file's key to a tuple of the file path and
+    its last modified time (as a timestamp). The key is the file path with
+    its root folder removed or, if `relative` is True, the path relative
+    to `path`.
+    """
+    # The prefix to remove for relative keys
+    prefix = str(path)
+    if prefix.startswith("s3://"):
+        prefix = prefix[5:]
+    prefix = prefix.rstrip("/") + "/"
+
+    out = {}
+    for f, info in fs.find(path, detail=True).items():
+
+        # Make it relative to HOME_DIR if we need to
+        if local:
+            f = _relative_to_home(f)
+
+        # S3 reports a datetime; the local file system reports a timestamp
+        if "LastModified" in info:
+            mtime = info["LastModified"].timestamp()
+        else:
+            mtime = info["mtime"]
+
+        # Remove the root (or the listed path) from the file
+        if relative:
+            key = f[len(prefix) :] if f.startswith(prefix) else f
+        else:
+            key = "/".join(f.split("/")[1:])
+        out[key] = (f, mtime)
+
+    return out
+
+
+def _task_failed(task):
+    """
+    Check if a stopped ECS task exited with a non-zero exit code.
+
+    Failure entries from describe_tasks (which have no containers) count
+    as failed.
+    """
+    containers = task.get("containers", [])
+    return not containers or containers[0].get("exitCode") != 0
+
+
 def is_ec2_instance():
     """Check if an instance is running on ECS Fargate on AWS."""
     return os.getenv("AWS_EXECUTION_ENV") == "AWS_ECS_FARGATE"
@@ -32,6 +115,12 @@ class AWS:
     def __init__(self, debug=False):
         """Initialize the connection to AWS."""
 
+        # NOTE: these are slow to import, so only import them when needed
+        import boto3
+        from botocore.config import Config
+        from fsspec.implementations.local import LocalFileSystem
+        from s3fs import S3FileSystem
+
         self.debug = debug
 
         # Load any environment variables from .env files
@@ -44,18 +133,23 @@ class AWS:
         )
 
         # Set up the file systems
-        self.remote = S3FileSystem()
+        self.remote = S3FileSystem(
+            config_kwargs={"max_pool_connections": MAX_POOL_CONNECTIONS}
+        )
         self.local = LocalFileSystem(str(HOME_DIR))
 
-        # Set up clients
-        self.ecs = self.session.client("ecs")
-        self.ec2 = self.session.client("ec2")
-        self.s3 = self.session.client("s3")
+        # Set up clients, sharing a config sized for concurrent requests
+        config = Config(
+            max_pool_connections=MAX_POOL_CONNECTIONS,
+            retries={"mode": "adaptive", "max_attempts": 10},
+        )
+        self.ecs = self.session.client("ecs", config=config)
+        self.ec2 = self.session.client("ec2", config=config)
+        self.s3 = self.session.client("s3", config=config)
 
         # Set up the output s3 bucket (and create it if we need to)
         self.bucket_name = APP_NAME
-        if not self.remote.exists(self.bucket_name):
-            self.s3.create_bucket(Bucket=self.bucket_name)
+        self._init_bucket()
 
         # Are we running on AWS
         self.on_aws = is_ec2_instance()
@@ -65,8 +159,36 @@ class AWS:
         if not self.on_aws:
             self._init_cluster()
 
-    def _init_cluster(self):
-        """Initialize the ECS cluster."""
+    def _init_bucket(self):
+        """Make sure the output bucket exists, creating it if it doesn't."""
+
+        # The marker is specific to this bucket and region
+        marker = CACHE_DIR / f"bucket-{self.bucket_name}-{self.session.region_name}"
+
+        # Skip the check if we've verified the bucket recently
+        if marker.exists() and time.time() - marker.stat().st_mtime < BUCKET_MARKER_TTL:
+            return
+
+        if not self._s3_exists(f"s3://{self.bucket_name}"):
+            self.s3.create_bucket(Bucket=self.bucket_name)
+
+        # Mark the bucket as verified
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+
+    def _init_cluster(self, refresh=False):
+        """
+        Initialize the ECS cluster.
+
+        The cluster metadata is cached locally for up to an hour; pass
+        `refresh=True` to force re-fetching it from AWS.
+        """
+
+        # Try to load from the cache first
+        if not refresh and self._load_cluster_cache():
+            if self.debug:
+                logger.info(f"Loaded cluster metadata from {CLUSTER_CACHE_FILE}")
+            return
 
         # Verify that the cluster exists
         clusters = self.ecs.list_clusters()
@@ -80,23 +202,94 @@ class AWS:
             logger.info(f"Subnets: {self.subnets}")
 
         # Get the latest task definition
-        tasks = self.ecs.list_task_definitions(familyPrefix=APP_NAME, sort="ASC")
-        self.task_definition = tasks["taskDefinitionArns"][-1]
+        tasks = self.ecs.list_task_definitions(
+            familyPrefix=APP_NAME, sort="DESC", maxResults=1
+        )
+        if not tasks["taskDefinitionArns"]:
+            raise ValueError(f"No ECS task definitions found for family: {APP_NAME}")
+        self.task_definition = tasks["taskDefinitionArns"][0]
 
         if self.debug:
             logger.info(f"Task definition: {self.task_definition}")
 
+        # Save to the cache
+        self._save_cluster_cache()
+
+    def _load_cluster_cache(self):
+        """Load cached cluster metadata, returning whether it was fresh."""
+
+        if not CLUSTER_CACHE_FILE.exists():
+            return False
+
+        # Treat an unreadable cache as a miss
+        try:
+            cache = orjson.loads(CLUSTER_CACHE_FILE.read_bytes())
+            key = (cache["cluster_name"], cache["region"])
+            timestamp = cache["timestamp"]
+            subnets = cache["subnets"]
+            task_definition = cache["task_definition"]
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            return False
+
+        if (
+            key != (self.cluster_name, self.session.region_name)
+            or time.time() - timestamp > CLUSTER_CACHE_TTL
+        ):
+            return False
+
+        self.subnets = subnets
+        self.task_definition = task_definition
+        return True
+
+    def _save_cluster_cache(self):
+        """Save the cluster metadata to the local cache."""
+
+        cache = {
+            "timestamp": time.time(),
+            "cluster_name": self.cluster_name,
+            "region": self.session.region_name,
+            "subnets": self.subnets,
+            "task_definition": self.task_definition,
+        }
+        CLUSTER_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        CLUSTER_CACHE_FILE.write_bytes(orjson.dumps(cache))
+
     def exists(self, path):
         """See if a file exists."""
 
         # File is on AWS
         if path.startswith("s3://"):
-            fs = self.remote
-        else:
-            path = str(Path(path).resolve().relative_to(HOME_DIR))
-            fs = self.local
+            return self._s3_exists(path)
+
+        path = _relative_to_home(path)
+        return self.local.exists(path)
+
+    def _s3_exists(self, path):
+        """
+        See if a key (or folder) exists on S3.
 
-        return fs.exists(path)
+        This uses a direct HEAD request rather than the s3fs listing cache.
+        """
+        from botocore.exceptions import ClientError
+
+        bucket, key = parse_aws_path(path)
+        key = key.rstrip("/")
+
+        try:
+            if not key:
+                self.s3.head_bucket(Bucket=bucket)
+            else:
+                self.s3.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NoSuchBucket"):
+                raise
+
+        # Not an object, but it could still be a folder
+        if not key:
+            return False
+        resp = self.s3.list_objects_v2(Bucket=bucket, Prefix=f"{key}/", MaxKeys=1)
+        return resp.get("KeyCount", 0) > 0
 
     def submit_jobs(
         self,
@@ -117,12 +310,14 @@ class AWS:
         debug=False,
         ntasks=1,
         wait=False,
+        fail_fast=False,
+        refresh_cluster=False,
     ):
         """Submit jobs to the ECS cluster."""
 
         # Init if we need to
-        if not hasattr(self, "subnets"):
-            self._init_cluster()
+        if refresh_cluster or not hasattr(self, "subnets"):
+            self._init_cluster(refresh=refresh_cluster)
 
         # Set the network config
         NETWORK_CONFIG = {
@@ -168,28 +363,33 @@ class AWS:
             logger.debug(f"Output folder: {output_folder}")
         base_command += [f"--output-folder={output_folder}"]
 
-        # Run in parallel
-        tasks = []
-        for pid in range(0, ntasks):
+        # The arguments shared by every task
+        run_task_kwargs = {
+            "taskDefinition": self.task_definition,
+            "cluster": self.cluster_name,
+            "networkConfiguration": NETWORK_CONFIG,
+            "launchType": "FARGATE",
+        }
+
+        def _submit(pid):
+            """Submit a single task."""
 
             # Log
             logger.info(f"Submitting job #{pid}")
 
             # Build the final command
-            command = base_command + [f"--pid={pid}"]
+            # NOTE: the overrides are built per task since tasks run concurrently
+            command = [*base_command, f"--pid={pid}"]
+            overrides = {"containerOverrides": [{"name": APP_NAME, "command": command}]}
 
             # Submit job
-            task = self.ecs.run_task(
-                taskDefinition=self.task_definition,
-                cluster=self.cluster_name,
-                networkConfiguration=NETWORK_CONFIG,
-                launchType="FARGATE",
-                overrides={
-                    "containerOverrides": [{"name": APP_NAME, "command": command}]
-                },
-            )
+            return self.ecs.run_task(**run_task_kwargs, overrides=overrides)
 
-            tasks.append(task)
+        # Run in parallel
+        # NOTE: each task needs its own --pid, so we can't use run_task's count
+        max_workers = max(1, min(ntasks, MAX_SUBMIT_WORKERS))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            tasks = list(pool.map(_submit, range(0, ntasks)))
 
         # Do not wait for tasks to finish
         if not wait:
@@ -219,24 +419,11 @@ class AWS:
 
         # Wait for all jobs to complete
         logger.info(f"Waiting for tasks to complete")
-        waiter = self.ecs.get_waiter("tasks_stopped")
-        waiter.wait(
-            cluster=self.cluster_name,
-            tasks=task_ids,
-            WaiterConfig={"Delay": 60, "MaxAttempts": 500},
-        )
+        stopped_tasks = self._wait_for_tasks(task_ids, fail_fast=fail_fast)
         logger.info(f"...all tasks completed")
 
-        # Check for errors
-        task_results = self.ecs.describe_tasks(
-            cluster=self.cluster_name, tasks=task_ids
-        )
-
         # Check the exit codes
-        exit_codes = [
-            task["containers"][0]["exitCode"] for task in task_results["tasks"]
-        ]
-        if any([code != 0 for code in exit_codes]):
+        if any([_task_failed(task) for task in stopped_tasks]):
             logger.warning("One or more tasks failed!")
 
         # And combine
@@ -247,8 +434,73 @@ class AWS:
 
         return outfile
 
+    def _wait_for_tasks(self, task_ids, fail_fast=False):
+        """
+        Wait for ECS tasks to stop, polling with an exponential backoff.
+
+        Exit codes are checked as tasks stop; if `fail_fast` is True, the
+        remaining tasks are stopped as soon as one task fails.
+
+        Returns the descriptions of the stopped tasks; tasks that ECS could
+        not describe are included as their failure entries.
+        """
+        pending = list(task_ids)
+        stopped = []
+
+        n = 0
+        start = time.time()
+        while pending:
+
+            # Wait, starting with a short delay for fast jobs
+            delay = min(POLL_MAX_DELAY, POLL_INITIAL_DELAY * POLL_BACKOFF ** n)
+            if time.time() - start + delay > POLL_TIMEOUT:
+                raise TimeoutError(
+                    f"Timed out waiting for {len(pending)} task(s) to stop"
+                )
+            time.sleep(delay)
+            n += 1
+
+            # Only check on tasks that haven't stopped yet
+            # NOTE: describe_tasks accepts at most 100 tasks per call
+            done = set()
+            failed = False
+            for i in range(0, len(pending), DESCRIBE_TASKS_BATCH_SIZE):
+                batch = pending[i : i + DESCRIBE_TASKS_BATCH_SIZE]
+                resp = self.ecs.describe_tasks(cluster=self.cluster_name, tasks=batch)
+
+                for task in resp["tasks"]:
+                    if task["lastStatus"] == "STOPPED":
+                        stopped.append(task)
+                        done.add(task["taskArn"])
+                        if _task_failed(task):
+                            failed = True
+                            logger.warning(f"Task failed: {task['taskArn']}")
+
+                # Tasks that ECS can no longer find will never stop, and
+                # their chunks will never be written, so count them as failed
+                for failure in resp.get("failures", []):
+                    logger.warning(f"Could not describe task: {failure}")
+                    stopped.append(failure)
+                    done.add(failure["arn"])
+                    failed = True
+
+            # Trim to tasks that are still running
+            pending = [arn for arn in pending if arn not in done]
+
+            # Stop the rest if one failed
+            if failed and fail_fast:
+                for arn in pending:
+                    self.ecs.stop_task(cluster=self.cluster_name, task=arn)
+                raise ValueError("One or more tasks failed; all tasks stopped.")
+
+            if self.debug:
+                logger.debug(f"{len(pending)} task(s) still running")
+
+        return stopped
+
     def combine_parallel_results(self, flavor, dataset, output_folder):
         """Iterate through parallel, chunked scraping results from AWS."""
+        import pandas as pd
 
         # Invalidate the cache
         self.remote.invalidate_cache()
@@ -266,48 +518,53 @@ class AWS:
         tags = [f"{flavor}_results", f"{flavor}_input"]
         extensions = [".json", ".csv"]
 
-        data_file = None
-        for i, (tag, extension) in enumerate(zip(tags, extensions)):
-
-            # Get the files
-            pattern = f"{output_folder}/{tag}*{extension}"
-            files = sorted(fs.glob(pattern))
-            N = len(files)
-            if N == 0:
+        # List the folder once and split the files by tag
+        all_files = fs.ls(output_folder, detail=False)
+        files_by_tag = []
+        for tag, extension in zip(tags, extensions):
+            files = sorted(
+                f
+                for f in all_files
+                if fnmatch(os.path.basename(f), f"{tag}*{extension}")
+            )
+            if len(files) == 0:
                 raise ValueError(
                     f"No files found for dataset '{dataset}' and kind '{flavor}' in output folder '{output_folder}'"
                 )
+            files_by_tag.append(files)
 
-            # Combine
-            if i == 0:
-                logger.info(
-                    f"Combining {N} files for dataset '{dataset}' and kind '{flavor}'"
-                )
-            results = None
-            for f in files:
+        logger.info(
+            f"Combining {len(files_by_tag[0])} files for dataset '{dataset}' and kind '{flavor}'"
+        )
+
+        # Fetch all of the files concurrently, with a single GET per file
+        blobs = fs.cat(list(chain.from_iterable(files_by_tag)))
 
-                with fs.open(f, "rb") as ff:
+        data_file = None
+        for i, (tag, extension) in enumerate(zip(tags, extensions)):
 
-                    # load this result
-                    if extension == ".json":
-                        r = json.loads(ff.read())
+            # Accumulate the chunks and concatenate once
+            chunks = []
+            for f in files_by_tag[i]:
 
-                        # Convert to a list if we need to
-                        if isinstance(r, dict):
-                            r = [v for _, v in r.items() if v]
+                # load this result, freeing the raw bytes as we go
+                blob = blobs.pop(f)
+                if extension == ".json":
+                    r = orjson.loads(blob)
+
+                    # Convert to a list if we need to
+                    if isinstance(r, dict):
+                        r = [v for _, v in r.items() if v]
+                else:
+                    r = pd.read_csv(BytesIO(blob), header=None)
 
-                        # Add the results
-                        if results is None:
-                            results = r
-                        else:
-                            results += r
-                    else:
+                chunks.append(r)
 
-                        r = pd.read_csv(ff, header=None)
-                        if results is None:
-                            results = r
-                        else:
-                            results = pd.concat([results, r])
+            # Combine the chunks
+            if extension == ".json":
+                results = list(chain.from_iterable(chunks))
+            else:
+                results = pd.concat(chunks, copy=False, ignore_index=True)
 
             # Normalize the output file
             filename = f"{output_folder}/../{tag}{extension}"
@@ -322,11 +579,12 @@ class AWS:
                 logger.info(f"Total number of results from AWS: {len(results)}")
                 logger.info(f"Saving combined results to {filename}")
 
-            with fs.open(filename, "w") as ff:
-                if extension == ".json":
-                    ff.write(json.dumps(results))
-                else:
-                    results.to_csv(ff, header=False, index=False)
+            # Write with a single PUT
+            if extension == ".json":
+                data = orjson.dumps(results)
+            else:
+                data = results.to_csv(header=False, index=False).encode()
+            fs.pipe_file(filename, data)
 
         return data_file
 
@@ -369,7 +627,7 @@ class AWS:
             dest_fs = self.local
 
             # Make sure dest is relative to HOME_DIR
-            dest = str(Path(dest).resolve().relative_to(HOME_DIR))
+            dest = _relative_to_home(dest)
 
         # Local to AWS
         else:
@@ -377,31 +635,38 @@ class AWS:
             dest_fs = self.remote
 
             # Make sure source is relative to HOME_DIR
-            source = str(Path(source).resolve().relative_to(HOME_DIR))
-
-        # Get the source files
-        source_files = source_fs.find(source)
-        for source_file in source_files:
+            source = _relative_to_home(source)
 
-            # Make it relative to HOME_DIR if we need to
-            if SOURCE == "local":
-                source_file = str(Path(source_file).resolve().relative_to(HOME_DIR))
+        # List both sides up front, rather than checking files one at a time
+        source_files = _list_files(source_fs, source, local=(SOURCE == "local"))
+        # NOTE: dest keys must be relative to dest to match dest_file below
+        dest_files = _list_files(dest_fs, dest, local=(SOURCE == "aws"), relative=True)
 
-            # Remove the root from the source file
-            source_file_key = "/".join(source_file.split("/")[1:])
+        # Collect the files that need transferring
+        transfers = []
+        for source_file_key, (source_file, source_mtime) in source_files.items():
 
             # Get source file path on dest system
             dest_file = f"{dest}/{source_file_key}"
 
             # Update if file doesn't exist or is out of date
-            if not Path(dest_file).exists() or source_fs.modified(
-                source_file
-            ) > dest_fs.modified(dest_file):
+            if (
+                source_file_key not in dest_files
+                or source_mtime > dest_files[source_file_key][1]
+            ):
 
                 logger.info(f"Syncing {source_file} to {dest_file}")
-                if not dry_run:
-
-                    if SOURCE == "aws":
-                        self.remote.get(source_file, str(HOME_DIR / dest_file))
-                    else:
-                        self.remote.put(str(HOME_DIR / source_file), dest_file)
+                if SOURCE == "aws":
+                    transfers.append((source_file, str(HOME_DIR / dest_file)))
+                else:
+                    transfers.append((str(HOME_DIR / source_file), dest_file))
+
+        # Transfer them all concurrently
+        # NOTE: fsspec sorts the source paths and then pairs them with the
+        # dest paths by position, so the pairs must be sorted by source
+        if transfers and not dry_run:
+            sources, dests = map(list, zip(*sorted(transfers)))
+            if SOURCE == "aws":
+                self.remote.get(sources, dests, batch_size=SYNC_BATCH_SIZE)
+            else:
+                self.remote.put(sources, dests, batch_size=SYNC_BATCH_SIZE)
@@ -2,7 +2,6 @@ import os
 from datetime import date
 from pathlib import Path
 
-import pandas as pd
 import simplejson as json
 from loguru import logger
 
@@ -47,6 +46,8 @@ def load_input_data(
     aws : AWS
     tag : str, optional
     """
+    import pandas as pd
+
     # Get the input CSV
     if flavor == "portal":
 